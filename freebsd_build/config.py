@@ -30,6 +30,30 @@ const char kernconfstring[] __attribute__ ((section("kern_conf"))) =
 '''.lstrip()
 
 
+# XXX we're assuming no one uses env directives anymore...
+ENV_C = '''
+#include <sys/types.h>
+#include <sys/systm.h>
+
+int envmode = 0;
+char static_env[] = {
+"\\0"
+};
+'''.lstrip()
+
+
+# XXX other archs will need this to actually work...
+HINTS_C = '''
+#include <sys/types.h>
+#include <sys/systm.h>
+
+int hintmode = 0;
+char static_hints[] = {
+"\\0"
+};
+'''.lstrip()
+
+
 class ConfigError(Exception):
     pass
 
@@ -82,47 +106,26 @@ def generate(configfile, machine=None, srcpath=None, buildpath='build'):
 
     options.write_headers(buildpath, config)
 
-    # XXX we're assuming no one uses env directives anymore...
     with open(os.path.join(buildpath, 'env.c'), 'w') as env:
-        env.write('#include <sys/types.h>\n')
-        env.write('#include <sys/systm.h>\n')
-        env.write('\n')
-        env.write('int envmode = 0;\n')
-        env.write('char static_env[] = {\n')
-        env.write('"\\0"\n')
-        env.write('};\n')
-
-    # XXX other archs will need this to actually work...
+        env.write(ENV_C)
+
     with open(os.path.join(buildpath, 'hints.c'), 'w') as hints:
-        hints.write('#include <sys/types.h>\n')
-        hints.write('#include <sys/systm.h>\n')
-        hints.write('\n')
-        hints.write('int hintmode = 0;\n')
-        hints.write('char static_hints[] = {\n')
-        hints.write('"\\0"\n')
-        hints.write('};\n')
+        hints.write(HINTS_C)
 
     with open(os.path.join(buildpath, 'config.c'), 'w') as conf_c:
-        confdata = ['options CONFIG_AUTOGENERATED']
-        confdata.append(f'ident {config.ident}')
-        confdata.append(f'machine {config.machine}')
-        confdata.append(f'cpu {config.cpu}')
-
-        for makeopt in config.makeoptions:
-            confdata.append(f'makeoptions {makeopt}')
-
-        for option, value in config.options.items():
-            if option == 'MAXUSERS' and value == '0':
-                continue
-            elif option.startswith('DEV_'):
-                continue
-            if value in ('1', None):
-                confdata.append(f'options {option}')
-            else:
-                confdata.append(f'options {option}={value}')
-
-        for device in config.devices:
-            confdata.append(f'device {device}')
+        confdata = [
+            'options CONFIG_AUTOGENERATED',
+            f'ident {config.ident}',
+            f'machine {config.machine}',
+            f'cpu {config.cpu}',
+        ]
+        confdata += [f'makeoptions {makeopt}' for makeopt in config.makeoptions]
+        confdata += [
+            f'options {option}' if value in ('1', None) else f'options {option}={value}'
+            for option, value in config.options.items()
+            if not (option == 'MAXUSERS' and value == '0') and not option.startswith('DEV_')
+        ]
+        confdata += [f'device {device}' for device in sorted(config.devices)]
 
         confdata = '\\n\\\n'.join(confdata) + '\\n\\\n'
         conf_c.write(KERNCONF_TEMPLATE.replace('%%KERNCONFFILE%%', confdata))
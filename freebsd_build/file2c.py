@@ -3,33 +3,118 @@
 import argparse
 import sys
 
-def file2c(fp_in, fp_out, maxcount=0, pretty=False, hex=False, prefix='', suffix=''):
-    if prefix:
-        fp_out.write(f'{prefix}\n')
+DECIMAL = [f'{byte:d}' for byte in range(256)]
+HEXADECIMAL = [f'0x{byte:02x}' for byte in range(256)]
+
+CHUNK_SIZE = 1 << 20
+
+
+def line_limit(separator, indent):
+    # A new line is started once the tokens so far, their separators and the
+    # trailing comma run past column 70.
+    return 69 - len(indent.expandtabs()) + len(separator)
+
+
+def wrap_lines(text, separator, indent):
+    # A token starting past the limit begins a new line, so each line ends at
+    # the first separator followed by such a token. Returns the finished lines
+    # and the last one, which later input may still extend.
+    skip = line_limit(separator, indent) - len(separator) + 1
+    lines = []
+    start = 0
+    while True:
+        end = text.find(separator, start + skip)
+        if end < 0:
+            return lines, text[start:]
+        lines.append(text[start:end])
+        start = end + len(separator)
+
+
+def continue_line(column, count, separator, indent):
+    # Returns what goes in front of the next token and how many more tokens
+    # fit on the current line, given the number of tokens already on it
+    # (None before the first token).
+    if column is None:
+        return indent, count
+    if column == count:
+        return ',\n' + indent, count
+    return separator, count - column
+
 
-    count = linepos = 0
+def hex_lines(fp_in, fp_out, count, separator, indent):
+    # Hex tokens all have the same width, so every line holds the same number
+    # of bytes and can be cut straight out of the bytes.hex() rendering.
+    token_separator = separator + '0x'
+    line_separator = ',\n' + indent
+    width = len(HEXADECIMAL[0]) + len(separator)
+    stride = count * width
+    column = None
 
-    for byte in fp_in.read():
-        if count:
-            linepos += fp_out.write(',')
+    while True:
+        data = fp_in.read(CHUNK_SIZE)
+        if not data:
+            break
 
-        if (maxcount == 0 and linepos > 70) or (maxcount > 0 and count >= maxcount):
-            fp_out.write('\n')
-            count = linepos = 0
+        prefix, room = continue_line(column, count, separator, indent)
+        text = '0x' + data.hex(',').replace(',', token_separator)
+        lines = [text[:room * width - len(separator)]]
+        lines.extend(text[start:start + stride - len(separator)]
+                     for start in range(room * width, len(text), stride))
+        fp_out.write(prefix + line_separator.join(lines))
+        column = count - room + len(data) if len(lines) == 1 else (len(data) - room - 1) % count + 1
 
-        if pretty:
-            if count:
-                linepos += fp_out.write(' ')
-            else:
-                fp_out.write('\t')
-                linepos += 8
 
-        if hex:
-            linepos += fp_out.write(f'0x{byte:02x}')
+def table_lines(fp_in, fp_out, table, maxcount, separator, indent):
+    line_separator = ',\n' + indent
+    column = None
+    # When wrapping by width, the last line rendered may still be extended by
+    # the next chunk, so it is held back until more input arrives or the
+    # input ends.
+    line = ''
+
+    while True:
+        data = fp_in.read(CHUNK_SIZE)
+        if not data:
+            break
+
+        if maxcount == 0:
+            text = separator.join(map(table.__getitem__, data))
+            lines, line = wrap_lines(f'{line}{separator}{text}' if line else text, separator, indent)
+            if lines:
+                fp_out.write(indent + line_separator.join(lines) + ',\n')
+        elif maxcount < 0:
+            # Output never wraps, so there is nothing to hold back.
+            text = separator.join(map(table.__getitem__, data))
+            fp_out.write((indent if column is None else separator) + text)
+            column = 0
         else:
-            linepos += fp_out.write(f'{byte:d}')
-        
-        count += 1
+            tokens = list(map(table.__getitem__, data))
+            prefix, room = continue_line(column, maxcount, separator, indent)
+            lines = [tokens[:room]]
+            lines.extend(tokens[start:start + maxcount]
+                         for start in range(room, len(tokens), maxcount))
+            fp_out.write(prefix + line_separator.join(map(separator.join, lines)))
+            column = maxcount - room + len(tokens) if len(lines) == 1 else len(lines[-1])
+
+    if line:
+        fp_out.write(indent + line)
+
+
+def file2c(fp_in, fp_out, maxcount=0, pretty=False, hex=False, prefix='', suffix=''):
+    if prefix:
+        fp_out.write(f'{prefix}\n')
+
+    separator = ', ' if pretty else ','
+    indent = '\t' if pretty else ''
+
+    if hex and maxcount >= 0:
+        if maxcount == 0:
+            width = len(HEXADECIMAL[0]) + len(separator)
+            maxcount = line_limit(separator, indent) // width + 1
+        hex_lines(fp_in, fp_out, maxcount, separator, indent)
+    else:
+        table = HEXADECIMAL if hex else DECIMAL
+        table_lines(fp_in, fp_out, table, maxcount, separator, indent)
 
     fp_out.write('\n')
     if suffix:
@@ -1,3 +1,8 @@
+import sys
+
+from .util import read_files
+
+
 class KernelConfig:
     def __init__(self, filenames):
         self.filename = filenames[-1]
@@ -9,35 +14,28 @@ class KernelConfig:
         self.devices = set()
         self.makeoptions = []
 
-        for filename in filenames:
-            with open(filename) as fp:
-                self.parse_data(fp.read())
+        # Every option and device name that is set, folded to lower case
+        # when it is added so option_set() is a single lookup.
+        self.enabled = {'maxusers'}
+
+        self.parse_data(read_files(filenames))
     
     def option_set(self, option):
-        if option.upper() in self.options:
-            return True
-        if option.lower() in self.devices:
-            return True
-        return False
+        return option.lower() in self.enabled
 
     def parse_data(self, data):
         for line in data.splitlines():
-            if line.startswith('#'):
-                continue
-            comment = line.find('#')
-            if comment != -1:
-                line = line[:comment]
-            line = line.strip()
+            line = line.partition('#')[0].strip()
             if not line:
                 continue
 
-            directive, value = line.split()
+            directive, value = line.split(None, 1)
 
-            directive_method_name = f'directive_{directive}'
-            if not hasattr(self, directive_method_name):
+            method = self.DIRECTIVES.get(directive)
+            if method is None:
                 raise ConfigError(f"unknown directive in kernel configuration: {directive}")
 
-            getattr(self, directive_method_name)(value)
+            method(self, value)
 
     def directive_machine(self, value):
         if self.machine:
@@ -56,10 +54,23 @@ class KernelConfig:
     def directive_options(self, value):
         if '=' in value:
             option, value = value.split('=', 1)
-            self.options[option] = value
         else:
-            self.options[value] = None
+            option, value = value, None
+        option = sys.intern(option)
+        self.options[option] = value
+        self.enabled.add(option.lower())
     
     def directive_device(self, value):
-        self.options[f'DEV_{value.upper()}'] = '1'
+        value = sys.intern(value)
+        device = value.lower()
+        self.options[sys.intern(f'DEV_{value.upper()}')] = '1'
         self.devices.add(value)
+        self.enabled.add(device)
+        self.enabled.add(f'dev_{device}')
+
+
+KernelConfig.DIRECTIVES = {
+    name[len('directive_'):]: method
+    for name, method in vars(KernelConfig).items()
+    if name.startswith('directive_')
+}
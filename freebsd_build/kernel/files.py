@@ -1,22 +1,24 @@
+import re
+import sys
+
+from .util import read_file
+
+
+COMMENT_LINE_RE = re.compile(r'^#.*\n?', re.MULTILINE)
+COMMENT_RE = re.compile(r'[ \t]#.*')
+TRAILING_SPACE_RE = re.compile(r'[^\S\n]+$', re.MULTILINE)
+CONTINUATION_RE = re.compile(r'\\\n+')
+
+
 class File:
-    DIRECTIVES = set([
-        'standard',
-        'optional',
-        'profiling-routine',
-        'no-obj',
-        'no-implicit-rule',
-        'compile-with',
-        'dependency',
-        'before-depend',
-        'clean',
-        'warning',
-        'obj-prefix',
-        'local',
-    ])
+    __slots__ = ('filename', 'optional', 'conditions', 'dependencies', 'compile_with', 'clean',
+                 'obj', 'implicit_rule', 'obj_prefix', 'profiling', 'local', 'before_depend',
+                 'warning')
 
     def __init__(self, data):
         self.filename = None
-        self.optional = []
+        self.optional = ()
+        self.conditions = ()
         self.dependencies = []
         self.compile_with = None
         self.clean = set()
@@ -33,62 +35,90 @@ class File:
         if self.filename.endswith('ia32_genassym.o'):
             self.before_depend = True
 
-    def collect_non_directives(self, data):
-        elements = []
-        while data and data[0] not in self.DIRECTIVES:
-            elements.append(data.pop(0))
-        return elements
+    def collect_non_directives(self, tokens, i):
+        directives = self.DIRECTIVES
+        start = i
+        end = len(tokens)
+        while i < end and tokens[i] not in directives:
+            i += 1
+        return tokens[start:i], i
 
-    def quoted_string(self, data):
-        string = self.collect_non_directives(data)
+    def quoted_string(self, tokens, i):
+        string, i = self.collect_non_directives(tokens, i)
         string = ' '.join(string)
         if string.startswith('"') or string.startswith("'"):
             string = string[1:-1]
-        return string
+        return string, i
     
-    def quoted_list(self, data):
-        return [e.strip('"') for e in self.collect_non_directives(data)]
+    def quoted_list(self, tokens, i):
+        elements, i = self.collect_non_directives(tokens, i)
+        return [e.strip('"') for e in elements], i
 
     def parse_data(self, data):
         self.filename, data = data.split(None, 1)
-        data = data.split()
+        tokens = list(map(sys.intern, data.split()))
+        lookup = self.DIRECTIVES.get
+        i = 0
+        end = len(tokens)
 
-        while data:
-            directive = data.pop(0)
+        while i < end:
+            directive = tokens[i]
 
-            if directive not in self.DIRECTIVES:
+            method = lookup(directive)
+            if method is None:
                 raise ConfigError(f'Unknown directive for {self.filename}: {directive}')
-            
-            if directive == 'standard':
-                pass
-            elif directive == 'optional':
-                spec = self.collect_non_directives(data)
-                self.parse_optional_spec(spec)
-            elif directive == 'compile-with':
-                self.compile_with = self.quoted_string(data)
-            elif directive == 'clean':
-                clean_files = self.quoted_list(data)
-                self.clean.update([f for f in clean_files if f != self.filename])
-            elif directive == 'no-obj':
-                self.obj = False
-            elif directive == 'no-implicit-rule':
-                self.implicit_rule = False
-            elif directive == 'dependency':
-                self.dependencies.extend(self.quoted_list(data))
-            elif directive == 'obj-prefix':
-                self.obj_prefix = self.quoted_string(data)
-            elif directive == 'local':
-                self.local = True
-            elif directive == 'profiling-routine':
-                self.profiling = True
-            elif directive == 'before-depend':
-                self.before_depend = True
-            elif directive == 'warning':
-                self.warning = self.quoted_string(data)
-            else:
-                print(f'Skipping {directive} on {self.filename}')
-                while data and data[0] not in self.DIRECTIVES:
-                    data.pop(0)
+
+            i = method(self, tokens, i + 1)
+
+    def directive_standard(self, tokens, i):
+        return i
+
+    def directive_optional(self, tokens, i):
+        spec, i = self.collect_non_directives(tokens, i)
+        self.parse_optional_spec(spec)
+        return i
+
+    def directive_compile_with(self, tokens, i):
+        self.compile_with, i = self.quoted_string(tokens, i)
+        return i
+
+    def directive_clean(self, tokens, i):
+        clean_files, i = self.quoted_list(tokens, i)
+        self.clean.update([f for f in clean_files if f != self.filename])
+        return i
+
+    def directive_no_obj(self, tokens, i):
+        self.obj = False
+        return i
+
+    def directive_no_implicit_rule(self, tokens, i):
+        self.implicit_rule = False
+        return i
+
+    def directive_dependency(self, tokens, i):
+        dependencies, i = self.quoted_list(tokens, i)
+        self.dependencies.extend(dependencies)
+        return i
+
+    def directive_obj_prefix(self, tokens, i):
+        self.obj_prefix, i = self.quoted_string(tokens, i)
+        return i
+
+    def directive_local(self, tokens, i):
+        self.local = True
+        return i
+
+    def directive_profiling_routine(self, tokens, i):
+        self.profiling = True
+        return i
+
+    def directive_before_depend(self, tokens, i):
+        self.before_depend = True
+        return i
+
+    def directive_warning(self, tokens, i):
+        self.warning, i = self.quoted_string(tokens, i)
+        return i
 
     def parse_optional_spec(self, spec):
         runs = []
@@ -98,41 +128,42 @@ class File:
             if entry != '|':
                 run.append(entry)
             else:
-                runs.append(run)
+                runs.append(tuple(run))
                 run = []
         
         if run:
-            runs.append(run)
+            runs.append(tuple(run))
         
-        self.optional = runs
+        self.optional = tuple(runs)
+
+        # Each alternative as the names that must be enabled and the names
+        # that must not be, so it can be tested with set operations.
+        self.conditions = tuple(
+            (frozenset(item.lower() for item in run if item[0] != '!'),
+             frozenset(item[1:].lower() for item in run if item[0] == '!'))
+            for run in runs
+        )
 
     def configured(self, config):
-        if not self.optional:
+        if not self.conditions:
             return True
 
-        for condition in self.optional:
-            configured = True
-            for item in condition:
-                expected = True
-                if item[0] == '!':
-                    expected = False
-                    item = item[1:]
-
-                if config.option_set(item) is not expected:
-                    configured = False
-                    break
-            
-            if configured:
-                return True
-        
-        return False
+        enabled = config.enabled
+        return any(positive <= enabled and negative.isdisjoint(enabled)
+                   for positive, negative in self.conditions)
+
+
+File.DIRECTIVES = {
+    sys.intern(name[len('directive_'):].replace('_', '-')): method
+    for name, method in vars(File).items()
+    if name.startswith('directive_')
+}
 
 
 class Files(list):
     def __init__(self, filenames):
         for filename in filenames:
-            with open(filename) as fp:
-                self.parse_data(fp.read())
+            self.parse_data(read_file(filename))
 
         self.parse_data('config.c standard local')
         self.parse_data('env.c standard local')
@@ -141,25 +172,14 @@ class Files(list):
         self.parse_data('vnode_if.c standard local')
 
     def parse_data(self, data):
-        prev_line = ''
-
-        for line in data.splitlines():
-            if line.startswith('#'):
-                continue
-            comment = line.find(' #')
-            if comment == -1:
-                comment = line.find('\t#')
-            if comment != -1:
-                line = line[:comment]
-            line = line.rstrip()
-            if not line:
-                continue
-            
-            if line.endswith('\\'):
-                prev_line += line[:-1]
-                continue
-
-            line = prev_line + line
-            prev_line = ''
-
-            self.append(File(line))
+        data = COMMENT_LINE_RE.sub('', data)
+        data = COMMENT_RE.sub('', data)
+        data = TRAILING_SPACE_RE.sub('', data)
+        # A continuation with nothing but blank lines after it never gets its
+        # next line, so the unfinished entry is dropped.
+        unfinished = data.rstrip('\n').endswith('\\')
+        data = CONTINUATION_RE.sub('', data)
+        if unfinished:
+            data = data.rpartition('\n')[0]
+
+        self.extend([File(line) for line in data.split('\n') if line])
@@ -1,48 +1,45 @@
 import os.path
+import sys
+from collections import defaultdict
+
+from .util import read_files
 
 
 class Options(dict):
     def __init__(self, filenames):
         self['MAXUSERS'] = 'opt_maxusers.h'
 
-        for filename in filenames:
-            with open(filename) as fp:
-                self.parse_data(fp.read())
+        self.parse_data(read_files(filenames))
 
     def parse_data(self, data):
         for line in data.splitlines():
-            if line.startswith('#'):
-                continue
-            comment = line.find('#')
-            if comment != -1:
-                line = line[:comment]
-            line = line.strip()
+            line = line.partition('#')[0].strip()
             if not line:
                 continue
 
-            try:
-                option, header = line.split()
-            except ValueError:
-                option = line.strip()
+            fields = line.split(None, 1)
+            option = fields[0]
+            if len(fields) == 2:
+                header = fields[1]
+            else:
                 header = f'opt_{option.lower()}.h'
 
-            self[option] = header
+            self[sys.intern(option)] = sys.intern(header)
 
     def write_headers(self, path, config):
-        optfiles = {filename: [] for filename in self.values()}
+        # Every declared header is written, even if no option in it is set.
+        optfiles = defaultdict(list, {filename: [] for filename in self.values()})
 
         for option, value in config.options.items():
-            if option not in self and option.startswith('DEV_'):
+            filename = self.get(option)
+            if filename is None:
+                if not option.startswith('DEV_'):
+                    raise KeyError(option)
                 filename = f'opt_{option[4:].lower()}.h'
-                optfiles[filename] = [(option, value)]
-            else:
-                filename = self[option]
-                optfiles[filename].append((option, value))
+            optfiles[filename].append((option, value))
         
         for filename, options in optfiles.items():
+            lines = [f'#define {option} {value}\n' if value else f'#define {option}\n'
+                     for option, value in options]
             with open(os.path.join(path, filename), 'w') as optfile:
-                for option, value in options:
-                    optfile.write(f'#define {option}')
-                    if value:
-                        optfile.write(f' {value}')
-                    optfile.write('\n')
+                optfile.writelines(lines)
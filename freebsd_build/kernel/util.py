@@ -0,0 +1,25 @@
+import mmap
+import os
+
+
+MAP_FLAGS = mmap.MAP_SHARED | getattr(mmap, 'MAP_POPULATE', 0)
+
+
+def read_file(filename):
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if not size:
+            return ''
+        data = mmap.mmap(fd, size, flags=MAP_FLAGS, prot=mmap.PROT_READ)
+    finally:
+        os.close(fd)
+
+    # Decoding straight from the mapping skips the intermediate bytes copy
+    # that a buffered read would make.
+    with data:
+        return str(data, 'utf-8')
+
+
+def read_files(filenames):
+    return '\n'.join(map(read_file, filenames))
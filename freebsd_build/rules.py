@@ -1,12 +1,37 @@
 import fnmatch
+import functools
 import os
 import re
 
 
-CFLAGS = '-O2 -pipe -fno-strict-aliasing -g -nostdinc --target=x86_64-unknown-freebsd -I. -I$S -I$S/contrib/libfdt -D_KERNEL -DHAVE_KERNEL_OPTION_HEADERS -include opt_global.h -fPIC -fno-common -fno-omit-frame-pointer -mno-omit-leaf-frame-pointer -MD -MF.depend.$out -MT$out -mcmodel=kernel -mno-red-zone -mno-mmx -mno-sse -msoft-float -fno-asynchronous-unwind-tables -ffreestanding -fwrapv -fstack-protector -gdwarf-2 -Wall -Wredundant-decls -Wnested-externs -Wstrict-prototypes -Wmissing-prototypes -Wpointer-arith -Winline -Wcast-qual -Wundef -Wno-pointer-sign -D__printf__=__freebsd_kprintf__ -Wmissing-include-dirs -fdiagnostics-show-option -Wno-unknown-pragmas -Wno-error-tautological-compare -Wno-error-empty-body -Wno-error-parentheses-equality -Wno-error-unused-function -Wno-error-pointer-sign -Wno-error-shift-negative-value -Wno-error-address-of-packed-member -mno-aes -mno-avx -std=iso9899:1999'.split()
+CFLAGS = tuple('-O2 -pipe -fno-strict-aliasing -g -nostdinc --target=x86_64-unknown-freebsd -I. -I$S -I$S/contrib/libfdt -D_KERNEL -DHAVE_KERNEL_OPTION_HEADERS -include opt_global.h -fPIC -fno-common -fno-omit-frame-pointer -mno-omit-leaf-frame-pointer -MD -MF.depend.$out -MT$out -mcmodel=kernel -mno-red-zone -mno-mmx -mno-sse -msoft-float -fno-asynchronous-unwind-tables -ffreestanding -fwrapv -fstack-protector -gdwarf-2 -Wall -Wredundant-decls -Wnested-externs -Wstrict-prototypes -Wmissing-prototypes -Wpointer-arith -Winline -Wcast-qual -Wundef -Wno-pointer-sign -D__printf__=__freebsd_kprintf__ -Wmissing-include-dirs -fdiagnostics-show-option -Wno-unknown-pragmas -Wno-error-tautological-compare -Wno-error-empty-body -Wno-error-parentheses-equality -Wno-error-unused-function -Wno-error-pointer-sign -Wno-error-shift-negative-value -Wno-error-address-of-packed-member -mno-aes -mno-avx -std=iso9899:1999'.split())
+CFLAGS_GENASSYM = tuple(f for f in CFLAGS if f not in ('-flto', '-fno-common'))
+
+VARIABLE_RE = re.compile(r'\$\{([^}]*)\}')
+NORMAL_C_ARGS_RE = re.compile(r'.*NORMAL_C:(.*?)\}')
+CFLAGS_ARGS_RE = re.compile(r'.*CFLAGS:(.*?)\}')
+
+# make(1) variables that have a ninja equivalent other than a plain $NAME.
+NINJA_VARIABLES = {
+    '.IMPSRC': '$in',
+    '.TARGET': '$out',
+}
+
+
+def ninja_variable(match):
+    name = match.group(1)
+    return NINJA_VARIABLES.get(name) or f'${name}'
+
+
+@functools.lru_cache(maxsize=None)
+def ninja_command(command):
+    return VARIABLE_RE.sub(ninja_variable, command)
 
 
 class Build:
+    __slots__ = ('output', 'rule', 'inputs', 'implicit_outputs', 'implicit_dependencies',
+                 'order_dependencies', 'variables')
+
     def __init__(self, output, rule, inputs=None, implicit_outputs=None, implicit_dependencies=None, order_dependencies=None, variables=None):
         self.output = output
         self.rule = rule
@@ -17,19 +42,19 @@ class Build:
         self.variables = variables or {}
 
     def __str__(self):
-        build = f'build {self.output}'
+        parts = ['build ', self.output]
         if self.implicit_outputs:
-            build += f' | {" ".join(self.implicit_outputs)}'
-        build += f': {self.rule} {" ".join(self.inputs)}'
+            parts += [' | ', ' '.join(self.implicit_outputs)]
+        parts += [': ', self.rule, ' ', ' '.join(self.inputs)]
         if self.implicit_dependencies:
-            build += f' | {" ".join(self.implicit_dependencies)}'
+            parts += [' | ', ' '.join(self.implicit_dependencies)]
         if self.order_dependencies:
-            build += f' || {" ".join(self.order_dependencies)}'
-        if self.variables:
-            for name, value in self.variables.items():
-                build += f'\n  {name} = {value}'
+            parts += [' || ', ' '.join(self.order_dependencies)]
+        for name, value in self.variables.items():
+            parts += ['\n  ', name, ' = ', value]
+        parts.append('\n')
 
-        return build + '\n'
+        return ''.join(parts)
 
 
 class BuildRules:
@@ -78,6 +103,8 @@ class BuildRules:
         'NM': 'nm',
         'CC': 'cc',
         'LD': '/Users/benno/src/llvm-build/bin/ld.lld',
+        'CFLAGS': ' '.join(CFLAGS),
+        'CFLAGS_GENASSYM': ' '.join(CFLAGS_GENASSYM),
     }
 
     DEFAULT_BUILDS = [
@@ -97,6 +124,8 @@ class BuildRules:
     ]
 
     PATTERNS = []
+    COMBINED_PATTERN = None
+    DEFAULT_RULES_TEXT = None
 
     def __init__(self, path, files, config, vars=None):
         self.path = path
@@ -110,7 +139,35 @@ class BuildRules:
     @classmethod    
     def add_processor(cls, pattern, processor):
         cls.PATTERNS.append((re.compile(pattern), processor))
+
+    @classmethod
+    def combined_pattern(cls):
+        # One alternation of every registered pattern, in registration order,
+        # so the processor for a compile-with line is found with one match.
+        # PATTERNS is shared with subclasses and only ever grows, so each
+        # class keeps its own copy keyed on how many patterns it covers.
+        # With no patterns at all there is nothing to match, rather than an
+        # empty alternation that matches everything.
+        cached = cls.__dict__.get('COMBINED_PATTERN')
+        if cached is None or cached[0] != len(cls.PATTERNS):
+            cached = cls.COMBINED_PATTERN = (len(cls.PATTERNS), re.compile('|'.join(
+                f'(?P<p{index}>{regex.pattern})'
+                for index, (regex, processor) in enumerate(cls.PATTERNS)
+            )) if cls.PATTERNS else None)
+        return cached[1]
     
+    @classmethod
+    def default_rules_text(cls):
+        # Cached on each class itself, so a subclass that overrides
+        # DEFAULT_RULE_DEFINITIONS never picks up its parent's text.
+        text = cls.__dict__.get('DEFAULT_RULES_TEXT')
+        if text is None:
+            text = cls.DEFAULT_RULES_TEXT = ''.join(
+                f'rule {name}\n' + ''.join(f'  {varname} = {value}\n' for varname, value in variables.items())
+                for name, variables in cls.DEFAULT_RULE_DEFINITIONS.items()
+            )
+        return text
+
     @classmethod
     def add_for_pattern(cls, pattern):
         def f(processor):
@@ -128,75 +185,85 @@ class BuildRules:
 
         filename = os.path.join(self.path, filename)
 
-        self.vars['CFLAGS'] = ' '.join(CFLAGS)
-        cflags_genassym = [f for f in CFLAGS if f not in ('-flto', '-fno-common')]
-        self.vars['CFLAGS_GENASSYM'] = ' '.join(cflags_genassym)
         self.vars['KERNEL_CONFIG'] = self.config.filename
 
+        # Many files share the same optional spec, so only evaluate each
+        # spec against the config once.
+        configured = {}
+        combined = self.combined_pattern()
+
+        config = self.config
+        patterns = self.PATTERNS
+        add_build = builds.append
+        add_early_build = early_builds.append
+        add_before_depend = before_depends.append
+        add_obj = objs.append
+        seen = set()
+        add_seen = seen.add
+
         for f in self.files:
-            if not f.configured(self.config):
-                continue
             if f.profiling:
                 continue
+            enabled = configured.get(f.conditions)
+            if enabled is None:
+                enabled = configured[f.conditions] = f.configured(config)
+            if not enabled:
+                continue
+            # The same source may be listed more than once, e.g. in both
+            # files and files.<machine>; only the first entry is built.
+            if f.filename in seen:
+                continue
+            add_seen(f.filename)
             if not f.compile_with:
-                extension = f.filename.rsplit('.', 1)[1]
+                basename = f.filename.rpartition('/')[2]
+                stem, _, extension = basename.rpartition('.')
 
                 if extension == 'c':
-                    obj = os.path.split(f.filename)[1]
-                    obj = obj[:-1] + 'o'
+                    obj = stem + '.o'
                     src = f.filename
                     if not f.local:
                         src = f'$S/{src}'
-                    builds.append(Build(obj, 'cc', [src]))
+                    add_build(Build(obj, 'cc', [src]))
                     if f.obj:
-                        objs.append(obj)
+                        add_obj(obj)
                 elif extension == 'm':
-                    obj = os.path.split(f.filename)[1]
-                    c_obj = obj[:-1] + 'c'
-                    h_obj = obj[:-1] + 'h'
-                    obj = obj[:-1] + 'o'
+                    c_obj = stem + '.c'
+                    h_obj = stem + '.h'
+                    obj = stem + '.o'
 
                     builds.extend([
                         Build(c_obj, 'awk', ['$S/tools/makeobjops.awk', f'$S/{f.filename}'], variables={'args': '-c'}),
                         Build(obj, 'cc', [c_obj]),
                     ])
 
-                    before_depends.append(h_obj)
-                    early_builds.append(
+                    add_before_depend(h_obj)
+                    add_early_build(
                         Build(h_obj, 'awk', ['$S/tools/makeobjops.awk', f'$S/{f.filename}'], variables={'args': '-h'})
                     )
                     if f.obj:
-                        objs.append(obj)
+                        add_obj(obj)
                 elif extension == 'S':
-                    obj = os.path.split(f.filename)[1]
-                    obj = obj[:-1] + 'o'
-                    builds.append(Build(obj, 'as', [f'$S/{f.filename}']))
+                    obj = stem + '.o'
+                    add_build(Build(obj, 'as', [f'$S/{f.filename}']))
                     if f.obj:
-                        objs.append(obj)
+                        add_obj(obj)
                 else:
                     raise ConfigError(f'No idea what to do with {f.filename}')
             else:
-                for regex, processor in self.PATTERNS:
-                    match = regex.match(f.compile_with)
-                    if not match:
-                        continue
-
-                    build = processor(f, match)
+                match = combined and combined.match(f.compile_with)
+                if match and match.lastgroup is not None:
+                    regex, processor = patterns[int(match.lastgroup[1:])]
+                    build = processor(f, regex.match(f.compile_with))
                     if f.before_depend:
-                        before_depends.append(build.output)
-                        early_builds.append(build)
+                        add_before_depend(build.output)
+                        add_early_build(build)
                     else:
-                        builds.append(build)
+                        add_build(build)
 
                     if f.obj:
-                        objs.append(build.output)
-
-                    break
+                        add_obj(build.output)
                 else:
-                    rule = f.compile_with
-                    rule = rule.replace('${.IMPSRC}', '$in')
-                    rule = rule.replace('${.TARGET}', '$out')
-                    rule = re.sub(r'\$\{(.*?)\}', '$\\1', rule)
+                    rule = ninja_command(f.compile_with)
 
                     if rule in rules:
                         rule_name = rules[rule]
@@ -206,51 +273,51 @@ class BuildRules:
 
                     build = Build(f.filename, rule_name, f.dependencies)
                     if f.before_depend:
-                        before_depends.append(build.output)
-                        early_builds.append(build)
+                        add_before_depend(build.output)
+                        add_early_build(build)
                     else:
-                        builds.append(build)
+                        add_build(build)
 
                     if f.obj:
-                        objs.append(build.output)
+                        add_obj(build.output)
 
         objs.append('hack.pico')
 
-        with open(filename, 'w') as build:
-            build.write(f'MACHINE = {self.config.machine}\n')
+        out = [f'MACHINE = {self.config.machine}\n']
+
+        for name in ('S', 'CFLAGS'):
+            value = self.vars.pop(name)
+            out.append(f'{name} = {value}\n')
+        for name, value in self.vars.items():
+            out.append(f'{name} = {value}\n')
 
-            for name in ('S', 'CFLAGS'):
-                value = self.vars.pop(name)
-                build.write(f'{name} = {value}\n')
-            for name, value in self.vars.items():
-                build.write(f'{name} = {value}\n')
+        out.append('\n')
 
-            build.write('\n')
+        out.append(self.default_rules_text())
+        out.append('rule newvers\n')
+        out.append(f'  command = MAKE=./versmake.sh sh $S/conf/newvers.sh {self.config.ident}\n')
+        for command, name in rules.items():
+            out.append(f'rule {name}\n  command = {command}\n')
+        out.append('\n')
 
-            for name, variables in self.DEFAULT_RULE_DEFINITIONS.items():
-                build.write(f'rule {name}\n')
-                for varname, value in variables.items():
-                    build.write(f'  {varname} = {value}\n')
-            build.write('rule newvers\n')
-            build.write(f'  command = MAKE=./versmake.sh sh $S/conf/newvers.sh {self.config.ident}\n')
-            for command, name in rules.items():
-                build.write(f'rule {name}\n  command = {command}\n')
-            build.write('\n')
+        out.extend(map(str, early_builds))
+        out.extend(map(str, builds))
 
-            for b in early_builds:
-                build.write(str(b))
+        out.append('build vers.c | version: newvers\n')
 
-            for b in builds:
-                build.write(str(b))
-            
-            build.write('build vers.c | version: newvers\n')
+        out.append(f'build kernel.full: ld {" ".join(objs)}\n')
+        out.append(f'build kernel.debug: extract_debug kernel.full\n')
+        out.append(f'build kernel: strip_debug kernel.full | kernel.debug\n')
 
-            build.write(f'build kernel.full: ld {" ".join(objs)}\n')
-            build.write(f'build kernel.debug: extract_debug kernel.full\n')
-            build.write(f'build kernel: strip_debug kernel.full | kernel.debug\n')
+        out.append('\n')
+        out.append(f'build build.ninja: freebsd-config $KERNEL_CONFIG\n')
 
-            build.write('\n')
-            build.write(f'build build.ninja: freebsd-config $KERNEL_CONFIG\n')
+        # Write beside the target and rename over it, so an interrupted run
+        # never leaves ninja with a truncated build.ninja.
+        tmpfile = f'{filename}.tmp'
+        with open(tmpfile, 'w') as build:
+            build.write(''.join(out))
+        os.replace(tmpfile, filename)
 
 
 @BuildRules.add_for_pattern(r'\$\{AWK\} -f (\S+) (\S+) > (\S+)')
@@ -269,36 +336,43 @@ def as_rule(f, match):
     return Build(f.filename, 'as', [f.dependencies[0]], implicit_dependencies=f.dependencies[1:])
 
 
+@functools.lru_cache(maxsize=None)
+def cflags_modifiers(modifiers):
+    exclusions = [m[1:] for m in modifiers.split(':') if m.startswith('N')]
+    exact = frozenset(e for e in exclusions if '*' not in e)
+    globs = [fnmatch.translate(e) for e in exclusions if '*' in e]
+    wildcard = re.compile('|'.join(globs)) if globs else None
+
+    def excluded(flag):
+        return flag in exact or (wildcard is not None and wildcard.match(flag) is not None)
+
+    # CFLAGS never changes, so it only has to be filtered and joined once per
+    # distinct set of modifiers.
+    return excluded, ' '.join(f for f in CFLAGS if not excluded(f))
+
+
 @BuildRules.add_for_pattern(r'^\$\{NORMAL_C')
 @BuildRules.add_for_pattern(r'^\$\{CC\}')
 def cc_rule(f, match):
-    print(match.string)
-    cflags = list(CFLAGS)
     if 'NORMAL_C' in match.string:
-        args = re.match(r'.*NORMAL_C:(.*?)\}', match.string)
-        obj = os.path.split(f.filename)[1]
-        obj = obj[:-1] + 'o'
+        args = NORMAL_C_ARGS_RE.match(match.string)
+        obj = f.filename.rpartition('/')[2][:-1] + 'o'
         deps = [f'$S/{f.filename}']
         imp_deps = []
-        bits = match.string.split()[1:]
-        cflags.extend(bits)
+        extra = match.string.split()[1:]
     else:
-        args = re.match(r'.*CFLAGS:(.*?)\}', match.string)
+        args = CFLAGS_ARGS_RE.match(match.string)
         obj = f.filename
         deps = [f.dependencies[0]]
         imp_deps = f.dependencies[1:]
+        extra = []
 
-    if args:
-        for arg in args.group(1).split(':'):
-            if arg[0] == 'N':
-                arg = arg[1:]
-                if '*' in arg:
-                    cflags = [f for f in cflags if not fnmatch.fnmatchcase(f, arg)]
-                else:
-                    cflags = [f for f in cflags if f != arg]
-
+    excluded, cflags = cflags_modifiers(args.group(1) if args else '')
+    extra = [f for f in extra if not excluded(f)]
+    if extra:
+        cflags = ' '.join([cflags, *extra])
 
-    return Build(obj, 'cc', deps, implicit_dependencies=imp_deps, variables={'CFLAGS': ' '.join(cflags)})
+    return Build(obj, 'cc', deps, implicit_dependencies=imp_deps, variables={'CFLAGS': cflags})
 
 
 @BuildRules.add_for_pattern(r'.*(\$S/kern/genassym.sh) (\S+)')
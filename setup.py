@@ -91,6 +91,7 @@ setup(
         ],
     },
     install_requires=REQUIRED,
+    python_requires='>=3.8',
     include_package_data=True,
     license='BSD',
     classifiers=[
@@ -98,7 +99,7 @@ setup(
         # Full list: https://pypi.python.org/pypi?%3Aaction=list_classifiers
         'License :: OSI Approved :: BSD License',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.8',
         'Programming Language :: Python :: Implementation :: CPython',
     ],
     # $ setup.py publish support.